@@ -1,16 +1,95 @@
 import argparse
+import socket
 import time
-import json
+import threading
+from collections import OrderedDict, deque
 from bleson import get_provider, Observer
 from bleson.logger import log, set_level, ERROR, DEBUG
 from pprint import pprint
-from struct import unpack_from
+from struct import Struct
 import paho.mqtt.client as mqtt
 
+try:
+    from orjson import dumps as json_dumps
+except ImportError:
+    import json
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
+
 set_level(ERROR)
 
-govee_devices = {}
+govee_devices = OrderedDict()
+max_devices = 256
 log_interval = 59
+negative_cache_ttl = 300
+max_negative_cache = 1024
+batch_interval = 0.5
+max_pending = 1024
+mqtt_client = None
+_pending = deque(maxlen=max_pending)
+_negative_cache = OrderedDict()
+_negative_cache_expires = 0
+_ha_discovery_cache = {}
+_unpack_hhb = Struct("<HHB").unpack_from
+
+# Manufacturer data prefix -> (expected length, offset of the temp/humidity/battery payload)
+_DEVICE_DECODERS = {
+    0x88EC: (9, 3),   # H5074
+    0x0188: (11, 6),  # H5179
+}
+
+def mqtt_connect():
+    """
+    Create the long-lived MQTT client and start its network loop.
+
+    The connection is established asynchronously and Paho reconnects on its own
+    after a disconnect, so callers can publish immediately.
+
+    Returns:
+    - MQTT client instance.
+    """
+    global mqtt_client
+    protocol = mqtt.MQTTv5 if args.mqtt_protocol == "5" else mqtt.MQTTv311
+    client = mqtt.Client(client_id=args.mqtt_client_id, protocol=protocol)
+    if args.mqtt_username and args.mqtt_password:
+        client.username_pw_set(args.mqtt_username, args.mqtt_password)
+    client.on_connect = on_mqtt_connect
+    client.on_disconnect = on_mqtt_disconnect
+    client.reconnect_delay_set(min_delay=1, max_delay=60)
+    client.connect_async(args.mqtt_host, args.mqtt_port, 60)
+    client.loop_start()
+    mqtt_client = client
+    return client
+
+def on_mqtt_connect(client, userdata, flags, rc, properties=None):
+    """
+    Callback function for MQTT connects. Marks Home Assistant discovery as unsent for every
+    known device so it is re-announced in case the broker lost its retained messages.
+
+    Parameters:
+    - client: MQTT client instance.
+    - userdata: User data set on the client.
+    - flags: Response flags sent by the broker.
+    - rc: Connection result code.
+    - properties: MQTTv5 properties, if any.
+    """
+    if rc == 0:
+        for dev in list(govee_devices.values()):
+            dev["discovery_sent"] = False
+
+def on_mqtt_disconnect(client, userdata, rc, properties=None):
+    """
+    Callback function for MQTT disconnects. Paho's network loop handles the reconnect.
+
+    Parameters:
+    - client: MQTT client instance.
+    - userdata: User data set on the client.
+    - rc: Disconnect reason code.
+    - properties: MQTTv5 properties, if any.
+    """
+    if rc != 0 and args.verbose:
+        print(f"Disconnected from MQTT broker [{args.mqtt_host}:{args.mqtt_port}] (rc={rc}), reconnecting")
 
 def mqtt_publish(event, data):
     """
@@ -24,45 +103,75 @@ def mqtt_publish(event, data):
         print("Not publishing empty data for: ", event)
         return
 
+    # Prepare payload for publishing
+    payload = {
+        'temperature': data['temperature'],
+        'humidity': data['humidity'],
+        'battery': data['battery'],
+        'rssi': data['rssi'],
+        'timestamp': data['timestamp']
+    }
+
     try:
-        client = mqtt.Client()
-        if args.mqtt_username and args.mqtt_password:
-            client.username_pw_set(args.mqtt_username, args.mqtt_password)
-        client.connect(args.mqtt_host, args.mqtt_port, 60)
-        client.loop_start()
-
-        # Prepare payload for publishing
-        payload = {
-            'temperature': data['temperature'],
-            'humidity': data['humidity'],
-            'battery': data['battery'],
-            'rssi': data['rssi'],
-            'timestamp': data['timestamp']
-        }
+        client = mqtt_client or mqtt_connect()
 
         if args.verbose:
             print(f"Publishing {event} to MQTT [{args.mqtt_host}:{args.mqtt_port}] on topic {args.mqtt_topic}: {payload}")
 
-        # Publish sensor data
-        client.publish(args.mqtt_topic, json.dumps(payload))
-
-        # Send Home Assistant autodiscovery messages if enabled
-        if args.ha_discovery:
-            send_ha_discovery_messages(client, data)
+        # Publish sensor data, or queue it for the next batch
+        if args.mqtt_batch:
+            _pending.append((args.mqtt_topic, json_dumps(payload)))
+        else:
+            client.publish(args.mqtt_topic, json_dumps(payload), qos=0)
 
-        client.loop_stop()
+        # Send Home Assistant autodiscovery messages once per device if enabled
+        if args.ha_discovery and not data.get("discovery_sent"):
+            data["discovery_sent"] = send_ha_discovery_messages(client, data)
 
-    except mqtt.MQTTException as e:
-        print(f"Failed to connect to MQTT broker: {e}")
+    except (mqtt.MQTTException, ValueError) as e:
+        print(f"Failed to publish to MQTT broker: {e}")
         print(f"  Payload was: {payload}")
 
-def send_ha_discovery_messages(client, data):
+def flush_pending(client):
     """
-    Send Home Assistant autodiscovery messages.
+    Publish all queued sensor payloads, one JSON array per topic.
 
     Parameters:
     - client: MQTT client instance.
+    """
+    batches = {}
+    while _pending:
+        topic, payload = _pending.popleft()
+        batches.setdefault(topic, []).append(payload)
+
+    for topic, payloads in batches.items():
+        try:
+            client.publish(topic, b"[" + b",".join(payloads) + b"]", qos=0)
+        except (mqtt.MQTTException, ValueError) as e:
+            print(f"Failed to publish to MQTT broker: {e}")
+            print(f"  Payloads were: {payloads}")
+
+def publish_worker(client, stop_event):
+    """
+    Drain the publish queue every batch_interval seconds until stop_event is set.
+
+    Parameters:
+    - client: MQTT client instance.
+    - stop_event: threading.Event used to stop the worker.
+    """
+    while not stop_event.wait(batch_interval):
+        flush_pending(client)
+    flush_pending(client)
+
+def build_ha_discovery_messages(data):
+    """
+    Build the serialized Home Assistant autodiscovery messages for a device.
+
+    Parameters:
     - data: Dictionary containing sensor data.
+
+    Returns:
+    - List of (topic, payload) tuples with JSON-encoded payloads.
     """
     device_id = data['address'].replace(":", "").lower()
     device_name = data['name']
@@ -98,6 +207,7 @@ def send_ha_discovery_messages(client, data):
         }
     ]
 
+    messages = []
     for payload in discovery_payloads:
         payload["state_topic"] = args.mqtt_topic
         payload["device"] = {
@@ -106,22 +216,32 @@ def send_ha_discovery_messages(client, data):
             "model": "Govee Sensor",
             "manufacturer": "Govee"
         }
-        client.publish(f"homeassistant/sensor/{device_id}/{payload['device_class']}/config", json.dumps(payload), retain=True)
+        messages.append((f"homeassistant/sensor/{device_id}/{payload['device_class']}/config", json_dumps(payload)))
+    return messages
 
-def twos_complement(n: int, w: int = 16) -> int:
+def send_ha_discovery_messages(client, data):
     """
-    Convert an integer to its two's complement representation.
+    Send Home Assistant autodiscovery messages.
+
+    The serialized messages are built once per device and cached.
 
     Parameters:
-    - n: Integer to convert.
-    - w: Width (number of bits) of the integer.
+    - client: MQTT client instance.
+    - data: Dictionary containing sensor data.
 
     Returns:
-    - Two's complement representation of the integer.
+    - True if every message was handed to the client, False if any was dropped (e.g. not connected yet).
     """
-    if n & (1 << (w - 1)):
-        n = n - (1 << w)
-    return n
+    messages = _ha_discovery_cache.get(data['address'])
+    if messages is None:
+        messages = build_ha_discovery_messages(data)
+        _ha_discovery_cache[data['address']] = messages
+
+    sent = True
+    for topic, payload in messages:
+        if client.publish(topic, payload, retain=True).rc != mqtt.MQTT_ERR_SUCCESS:
+            sent = False
+    return sent
 
 def process(mac):
     """
@@ -142,50 +262,67 @@ def on_advertisement(advertisement):
     Parameters:
     - advertisement: BLE advertisement data.
     """
+    global _negative_cache_expires
     log.debug(advertisement)
 
     mac = advertisement.address.address
-    if mac in govee_devices and advertisement.mfg_data is not None:
-        time_now = time.time()
-        if time_now - govee_devices[mac]["last_log"] > log_interval:
-            prefix = int(advertisement.mfg_data.hex()[0:4], 16)
-
-            # H5074 devices
-            if prefix == 0x88EC and len(advertisement.mfg_data) == 9:
-                raw_temp, hum, batt = unpack_from("<HHB", advertisement.mfg_data, 3)
-                govee_devices[mac]["temperature"] = float(twos_complement(raw_temp) / 100.0)
-                govee_devices[mac]["humidity"] = float(hum / 100.0)
-                govee_devices[mac]["battery"] = int(batt)
-                govee_devices[mac]["timestamp"] = time_now
-                govee_devices[mac]["address"] = mac
-
-                if advertisement.rssi is not None and advertisement.rssi != 0:
-                    govee_devices[mac]["rssi"] = advertisement.rssi
-                process(mac)
-                govee_devices[mac]["last_log"] = time_now
-
-            # H5179 devices
-            if prefix == 0x0188 and len(advertisement.mfg_data) == 11:
-                raw_temp, hum, batt = unpack_from("<HHB", advertisement.mfg_data, 6)
-                govee_devices[mac]["temperature"] = float(twos_complement(raw_temp) / 100.0)
-                govee_devices[mac]["humidity"] = float(hum / 100.0)
-                govee_devices[mac]["battery"] = int(batt)
-                govee_devices[mac]["timestamp"] = time_now
-                govee_devices[mac]["address"] = mac
-
-                if advertisement.rssi is not None and advertisement.rssi != 0:
-                    govee_devices[mac]["rssi"] = advertisement.rssi
+    # Known non-Govee devices, skipped until the cache is next cleared
+    if mac in _negative_cache:
+        return
+    dev = govee_devices.get(mac)
+    if dev is not None:
+        govee_devices.move_to_end(mac)
+        # Known device: only the manufacturer data matters, the name is never looked at
+        mfg = advertisement.mfg_data
+        if mfg is None or len(mfg) < 2:
+            return
+        # Rate-limit on the monotonic clock so wall clock steps cannot stall or flood updates
+        mono_now = time.monotonic()
+        if mono_now - dev["last_log_mono"] > log_interval:
+            # First two bytes, big-endian
+            prefix = (mfg[0] << 8) | mfg[1]
+
+            spec = _DEVICE_DECODERS.get(prefix)
+            if spec is not None and len(mfg) == spec[0]:
+                raw_temp, hum, batt = _unpack_hhb(mfg, spec[1])
+                # Temperature is a signed 16-bit value; sign-extend via the bias trick
+                dev["temperature"] = ((raw_temp ^ 0x8000) - 0x8000) / 100.0
+                dev["humidity"] = hum / 100.0
+                dev["battery"] = batt
+                dev["timestamp"] = time.time()
+                dev["address"] = mac
+
+                rssi = advertisement.rssi
+                if rssi is not None and rssi != 0:
+                    dev["rssi"] = rssi
                 process(mac)
-                govee_devices[mac]["last_log"] = time_now
+                dev["last_log_mono"] = mono_now
+        return
 
-    # Add new Govee device if detected
-    if advertisement.name is not None and advertisement.name.startswith("Govee"):
-        if mac not in govee_devices:
+    # Forget non-Govee devices periodically so renamed or reused addresses are re-checked
+    mono_now = time.monotonic()
+    if mono_now > _negative_cache_expires:
+        _negative_cache.clear()
+        _negative_cache_expires = mono_now + negative_cache_ttl
+
+    # Unknown device: only the name matters, the manufacturer data is never looked at
+    name = advertisement.name
+    if name is not None:
+        if name[:5] != "Govee":
+            _negative_cache[mac] = None
+            if len(_negative_cache) > max_negative_cache:
+                _negative_cache.popitem(last=False)
+        else:
+            # Drop the least recently seen device once the table is full
+            if len(govee_devices) >= max_devices:
+                evicted, _ = govee_devices.popitem(last=False)
+                _ha_discovery_cache.pop(evicted, None)
             govee_devices[mac] = {
                 "address": mac,
-                "name": advertisement.name.split("'")[0],
-                "last_log": 0,
-                "timestamp": 0
+                "name": name.split("'")[0],
+                "last_log_mono": float("-inf"),
+                "timestamp": 0,
+                "discovery_sent": False
             }
             if args.verbose:
                 print("Found " + govee_devices[mac]["name"])
@@ -201,23 +338,39 @@ if __name__ == "__main__":
     parser.add_argument("--mqtt_host", dest="mqtt_host", default="localhost", help="Hostname of MQTT broker (default: localhost)")
     parser.add_argument("--mqtt_port", dest="mqtt_port", type=int, default=1883, help="Port of MQTT broker (default: 1883)")
     parser.add_argument("--mqtt_topic", dest="mqtt_topic", default="govee/sensor_data", help="MQTT topic to publish to (default: govee/sensor_data)")
+    parser.add_argument("--mqtt_client_id", dest="mqtt_client_id", default=f"govee2mqtt-{socket.gethostname()}", help="MQTT client id, must be unique per broker (default: govee2mqtt-<hostname>)")
+    parser.add_argument("--mqtt_protocol", dest="mqtt_protocol", choices=["3.1.1", "5"], default="3.1.1", help="MQTT protocol version (default: 3.1.1)")
     parser.add_argument("--mqtt_username", dest="mqtt_username", help="MQTT username")
     parser.add_argument("--mqtt_password", dest="mqtt_password", help="MQTT password")
+    parser.add_argument("--mqtt_batch", dest="mqtt_batch", action="store_true", help="Coalesce sensor updates and publish them as a JSON array every 500 ms")
     parser.add_argument("--ha_discovery", dest="ha_discovery", action="store_true", help="Enable Home Assistant autodiscovery messages")
     parser.add_argument("-v", "--verbose", dest="verbose", action="store_true", help="Verbose mode")
 
     args = parser.parse_args()
+    if args.mqtt_batch and args.ha_discovery:
+        parser.error("--mqtt_batch publishes JSON arrays, which the --ha_discovery value templates cannot read")
 
     # Set up BLE observer
     adapter = get_provider().get_adapter()
     observer = Observer(adapter)
     observer.on_advertising_data = on_advertisement
 
+    # Connect to the MQTT broker once and reuse the connection for every publish
+    mqtt_connect()
+
+    if args.mqtt_batch:
+        stop_publishing = threading.Event()
+        publisher = threading.Thread(target=publish_worker, args=(mqtt_client, stop_publishing), daemon=True)
+        publisher.start()
+
     try:
-        # Start observing BLE advertisements
-        while True:
-            observer.start()
-            time.sleep(0.5)
-            observer.stop()
+        # Observe BLE advertisements continuously until interrupted
+        observer.start()
+        threading.Event().wait()
     except KeyboardInterrupt:
         observer.stop()
+        if args.mqtt_batch:
+            stop_publishing.set()
+            publisher.join()
+        mqtt_client.disconnect()
+        mqtt_client.loop_stop()